@@ -0,0 +1,66 @@
+# Compiled drop-in for pid_control.pid_control, build it with: python setup.py build_ext --inplace
+import numpy as np
+
+
+cdef class pid_control:
+    cdef public double Kp, Ki, Kd
+    cdef public double current_value, error, dt_error
+    cdef public long cycle
+    cdef double _inv_cycle
+
+    def __init__(self, double _kp=0.1, double _ki=0, double _kd=0.0001):
+        self.Kp = _kp
+        self.Ki = _ki
+        self.Kd = _kd
+
+        self.current_value = 0
+
+        self.cycle = 1
+        self._inv_cycle = 1.0
+
+        self.error = 0
+        self.dt_error = 0
+
+    def set_new_params(self, params):
+        self.Kp, self.Ki, self.Kd = params
+
+    cpdef void pid_calc(self, double _target):
+        self.error = _target - self.current_value
+        self.dt_error += self.error
+        self.current_value += self.Kp * self.error + self.Ki * self.dt_error + self.Kd * (self.dt_error * self._inv_cycle)
+        self.cycle += 1
+        self._inv_cycle = 1.0 / self.cycle
+
+    def simulate(self, double _target, Py_ssize_t steps):
+        cdef double cv = self.current_value, dterr = self.dt_error, err = self.error, inv_cyc = self._inv_cycle
+        cdef long cyc = self.cycle
+        out = np.empty((steps, 3), dtype=np.float64)
+        cdef double[:, :] view = out
+        cdef Py_ssize_t n
+        for n in range(steps):
+            self.pid_calc(_target)
+            view[n, 0] = self.current_value
+            view[n, 1] = self.dt_error
+            view[n, 2] = self.error
+        self.current_value, self.dt_error, self.error, self._inv_cycle = cv, dterr, err, inv_cyc
+        self.cycle = cyc
+        return out
+
+    def commit(self, step):
+        self.current_value, self.dt_error, self.error = step
+        self.cycle += 1
+        self._inv_cycle = 1.0 / self.cycle
+
+    def get_current_value(self):
+        return self.current_value
+
+    def __str__(self):
+        return "Current value = {0}, Error = {1}, Cycle = {2}".format(
+            int(self.current_value), int(self.error), self.cycle
+            )
+
+    def err(self):
+        return self.error
+
+    def pv(self):
+        return int(self.current_value)
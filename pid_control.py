@@ -0,0 +1,84 @@
+# This Python file uses the following encoding: utf-8
+import numpy as np
+
+# Without numba the kernels below simply run as plain Python
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda fn: fn
+
+
+@njit('Tuple((f8,f8,i8,f8,f8))(f8,f8,f8,f8,f8,i8,f8,f8)', cache=True, fastmath=True)
+def _pid_step(Kp, Ki, Kd, dterr, cv, cyc, inv_cyc, target):
+    # One PID iteration, returns the updated (current_value, dt_error, cycle, error, 1 / cycle)
+    err = target - cv
+    dterr += err
+    cv += Kp * err + Ki * dterr + Kd * (dterr * inv_cyc)
+    cyc += 1
+    return cv, dterr, cyc, err, 1.0 / cyc
+
+
+@njit('f8[:, :](f8,f8,f8,f8,f8,i8,f8,f8,i8)', cache=True, fastmath=True)
+def _pid_run(Kp, Ki, Kd, dterr, cv, cyc, inv_cyc, target, steps):
+    # Runs steps PID iterations against a fixed target, one (current_value, dt_error, error) row per iteration
+    out = np.empty((steps, 3))
+    for n in range(steps):
+        cv, dterr, cyc, err, inv_cyc = _pid_step(Kp, Ki, Kd, dterr, cv, cyc, inv_cyc, target)
+        out[n, 0] = cv
+        out[n, 1] = dterr
+        out[n, 2] = err
+    return out
+
+
+class pid_control:
+    __slots__ = ('Kp', 'Ki', 'Kd', 'current_value', 'cycle', '_inv_cycle', 'error', 'dt_error')
+
+    def __init__(self, _kp=0.1, _ki=0, _kd=0.0001):
+        self.Kp = _kp
+        self.Ki = _ki
+        self.Kd = _kd
+
+        self.current_value = 0
+
+        self.cycle = 1
+        self._inv_cycle = 1.0
+
+        self.error = 0
+        self.dt_error = 0
+
+    def set_new_params(self, params):
+        self.Kp, self.Ki, self.Kd = params
+
+    def pid_calc(self, _target):
+        # Every attribute is read once and written back once
+        self.current_value, self.dt_error, self.cycle, self.error, self._inv_cycle = _pid_step(
+            self.Kp, self.Ki, self.Kd, self.dt_error, self.current_value, self.cycle, self._inv_cycle, _target
+            )
+
+    def simulate(self, _target, steps):
+        # Runs steps iterations from the current state without changing it, returns one
+        # (current_value, dt_error, error) row per iteration to be applied in order with commit()
+        return _pid_run(
+            self.Kp, self.Ki, self.Kd, self.dt_error, self.current_value, self.cycle, self._inv_cycle, _target, steps
+            )
+
+    def commit(self, step):
+        # Applies the next row from simulate() as if pid_calc had been called
+        self.current_value, self.dt_error, self.error = step
+        self.cycle += 1
+        self._inv_cycle = 1.0 / self.cycle
+
+    def get_current_value(self):
+        return self.current_value
+
+    def __str__(self):
+        return "Current value = {0}, Error = {1}, Cycle = {2}".format(
+            int(self.current_value), int(self.error), self.cycle
+            )
+
+    def err(self):
+        return self.error
+
+    def pv(self):
+        return int(self.current_value)
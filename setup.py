@@ -0,0 +1,10 @@
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+# Only builds the optional compiled pid_control, widget.py falls back to the pure Python one without it
+setup(
+    ext_modules=cythonize(
+        [Extension('_pid_control', ['_pid_control.pyx'])],
+        compiler_directives={'language_level': 3},
+    ),
+)
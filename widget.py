@@ -1,12 +1,32 @@
 # This Python file uses the following encoding: utf-8
 import sys
 import traceback
+import logging
+import threading
 import time
 
 import serial
-import json
+import numpy as np
+
+# orjson parses straight from the received bytes, fall back to the stdlib
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    import json
+
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+# Use the Cython build of pid_control when it has been compiled (see setup.py)
+try:
+    from _pid_control import pid_control
+except ImportError:
+    from pid_control import pid_control
+
 from PySide6.QtWidgets import QApplication, QWidget
-from PySide6.QtCore import QRunnable, Signal, Slot, QObject, QThreadPool
+from PySide6.QtCore import QRunnable, Signal, Slot, QObject, QTimer, Qt
 from pglive.sources.data_connector import DataConnector
 from pglive.sources.live_axis_range import LiveAxisRange
 from pglive.sources.live_plot import LiveLinePlot
@@ -15,14 +35,25 @@ from pglive.kwargs import LeadingLine, Crosshair
 from pglive.sources.live_plot_widget import LivePlotWidget
 import pyqtgraph as pg  # type: ignore
 
+# Render the plot through OpenGL when PyOpenGL is available, the line
+# drawing then happens on the GPU instead of building a QPainterPath
+try:
+    import OpenGL  # noqa: F401
+    pg.setConfigOption('useOpenGL', True)
+    pg.setConfigOption('enableExperimental', True)
+except ImportError:
+    pass
+pg.setConfigOption('antialias', False)
+
 # Important:
 # You need to run the following command to generate the ui_form.py file
 #     pyside6-uic form.ui -o ui_form.py, or
 #     pyside2-uic form.ui -o ui_form.py
 from ui_form import Ui_Widget
 
+log = logging.getLogger(__name__)
+
 _alive = True
-setpoint = 0
 
 
 class WorkerSignals(QObject):
@@ -43,12 +74,16 @@ class WorkerSignals(QObject):
     progress
         int indicating % progress
 
+    samples
+        np.ndarray of samples collected since the last emit
+
     """
 
     finished = Signal()
     error = Signal(tuple)
     result = Signal(object)
     progress = Signal(object)
+    samples = Signal(object)
 
 
 class Worker(QRunnable):
@@ -96,64 +131,21 @@ class Worker(QRunnable):
             self.signals.finished.emit()  # Done
 
 
-class pid_control:
-    def __init__(self, _kp=0.1, _ki=0, _kd=0.0001):
-        self.Kp = _kp
-        self.Ki = _ki
-        self.Kd = _kd
-
-        self.current_value = 0
-
-        self.cycle = 1
-
-        self.error = 0
-        self.dt_error = 0
-
-    def set_new_params(self, params):
-        self.Kp, self.Ki, self.Kd = params
-
-    def calc_p(self):
-        return round(float(self.Kp * self.error), 4)
-
-    def calc_i(self):
-        return round(float(self.Ki * self.dt_error), 4)
-
-    def calc_d(self, _error):
-        return round(float(self.Kd * _error), 4)
-
-    def pid_calc(self, _target):
-        _c = 0
-        self.error = _target - self.current_value
-        _c += self.calc_p()
-
-        self.dt_error += self.error
-        _c += self.calc_i()
-
-        temp = self.dt_error / self.cycle
-        _c += self.calc_d(temp)
-
-        self.current_value += _c
-        self.cycle += 1
-
-    def get_current_value(self):
-        return self.current_value
-
-    def __str__(self):
-        return "Current value = {0}, Error = {1}, Cycle = {2}".format(
-            int(self.current_value), int(self.error), self.cycle
-            )
-
-    def err(self):
-        return self.error
-
-    def pv(self):
-        return int(self.current_value)
-
-
 class Serial:
+    # Fixed commands, already encoded
+    START = b"start\n"
+    PAUSE = b"pause\n"
+    STOP = b"stop\n"
+    # Received samples are handed to the GUI this many at a time
+    BATCH = 32
+
     def __init__(self, parent):
         super().__init__()
         self.parent = parent
+        self._rx_buf = bytearray()
+        self.signals = WorkerSignals()
+        # recv loops until close(), so it gets its own daemon thread rather than a pool thread
+        self._recv_thread = threading.Thread(target=self.recv, daemon=True)
         '''
         self.connection = serial.Serial(
             port='/dev/ttyS0',
@@ -162,13 +154,12 @@ class Serial:
             parity=serial.PARITY_NONE,
             stopbits=serial.STOPBITS_ONE,
             bytesize=serial.EIGHTBITS,
-            timeout=1,
+            timeout=0.05,
         )
+        self._recv_thread.start()
         '''
         self.pid_controller = pid_control()
-        self.threadpool = QThreadPool()
-        worker = Worker(self.calc)
-        self.threadpool.start(worker)
+        self.setpoint = 0.0
 
     def close(self):
         global _alive
@@ -177,32 +168,64 @@ class Serial:
 
     def recv(self):
         global _alive
+        buf = self._rx_buf
+        samples = np.empty(self.BATCH, dtype=np.float64)
+        count = 0
         while _alive:
-            try:
-                msg = self.connection.readline()
-                msg = json.loads(msg)
-                print(msg)
-                self.parent.data_connector.cb_append_data_point(msg["pos_cnt"])
-            except Exception as e:
-                pass
+            # Read everything that is waiting in one call and split the lines out here
+            n = self.connection.in_waiting
+            if not n:
+                # Don't sit on a partial batch while the line is quiet
+                if count:
+                    self.signals.samples.emit(samples[:count].copy())
+                    count = 0
+                time.sleep(0.001)
+                continue
+            buf.extend(self.connection.read(n))
+            while (i := buf.find(b"\n")) != -1:
+                line = bytes(buf[:i])
+                del buf[:i + 1]
+                pos_cnt = self.handle_line(line)
+                if pos_cnt is None:
+                    continue
+                samples[count] = pos_cnt
+                count += 1
+                if count == self.BATCH:
+                    self.signals.samples.emit(samples.copy())
+                    count = 0
+
+    def handle_line(self, line):
+        # Returns the pos_cnt of one received line as a float, or None if there isn't a usable one
+        try:
+            msg = json_loads(line)
+        except ValueError:
+            # Garbled line, just wait for the next one
+            return None
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s", msg)
+        if not isinstance(msg, dict):
+            return None
+        pos_cnt = msg.get("pos_cnt")
+        if pos_cnt is None:
+            return None
+        try:
+            return float(pos_cnt)
+        except (TypeError, ValueError):
+            return None
 
     def send(self, msg):
         if type(msg) is dict:
             # change this to what ever it needs to be
-            msg = json.dumps(msg)
-        msg += "\n"
-        print(msg)
-        self.connection.write(msg.encode())
+            msg = json_dumps(msg)
+        else:
+            msg = msg.encode()
+        msg += b"\n"
+        self.send_raw(msg)
 
-    def calc(self):
-        global setpoint
-        global _alive
-        while _alive:
-            self.pid_controller.pid_calc(setpoint)
-            #print(self.pid_controller)
-            self.parent.data_connector_pv.cb_append_data_point(self.pid_controller.pv())
-            self.parent.data_connector_sp.cb_append_data_point(setpoint)
-            time.sleep(.1)
+    def send_raw(self, msg):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s", msg)
+        self.connection.write(msg)
 
 
 class Widget(QWidget):
@@ -212,12 +235,23 @@ class Widget(QWidget):
         self.ui.setupUi(self)
         self.data_connector_sp = None
         self.data_connector_pv = None
+        self.data_connector_rx = None
         self.plot_sp = None
         self.plot_pv = None
+        self.plot_rx = None
+        # x value of the next sample received over serial
+        self._rx_sample = 0
         self.live_plot_widget = None
+        self.rx_plot_widget = None
+        # PID steps are computed 100 at a time and committed to the controller one per tick
+        self._batch = np.empty((0, 3))
+        self._batch_pos = 0
+        self._batch_sp = 0.0
         self.graph_setup()
         self.serial = Serial(self)
+        self.serial.signals.samples.connect(self._append_samples, Qt.QueuedConnection)
         self.message = {'Kp': 0.0, 'Ki': 0.0, 'Kd': 0.0, 'setpoint': 0.0}
+        self._last_params = (None, None, None, None)
         self.ui.Start_btn.clicked.connect(self.send_start)
         self.ui.Pause_btn.clicked.connect(self.send_pause)
         self.ui.Stop_btn.clicked.connect(self.send_stop)
@@ -226,10 +260,26 @@ class Widget(QWidget):
         self.ui.P_value_txt.setText('0.1')
         self.ui.I_value_txt.setText('0')
         self.ui.D_value_txt.setText('0.0001')
+        # Runs one PID step every 100 ms on the GUI thread
+        self._tick_timer = QTimer(self)
+        self._tick_timer.timeout.connect(self._pid_tick)
+        self._tick_timer.start(100)
 
     def closeEvent(self, event):
+        self._tick_timer.stop()
         self.serial.close()
 
+    def _pid_tick(self):
+        pid = self.serial.pid_controller
+        if self._batch_pos == len(self._batch):
+            self._batch_sp = self.serial.setpoint
+            self._batch = pid.simulate(self._batch_sp, 100)
+            self._batch_pos = 0
+        pid.commit(self._batch[self._batch_pos])
+        self._batch_pos += 1
+        self.data_connector_pv.cb_append_data_point(pid.pv())
+        self.data_connector_sp.cb_append_data_point(self._batch_sp)
+
     def graph_setup(self):
         left_axis = LiveAxis("left", axisPen="red", textPen="red")
         bottom_axis = LiveAxis(
@@ -261,38 +311,74 @@ class Widget(QWidget):
         self.live_plot_widget.addItem(self.plot_sp)
         self.live_plot_widget.addItem(self.plot_pv)
         # To add data to that line create another DataConnector object max points is how much "history" it keeps
-        self.data_connector_sp = DataConnector(self.plot_sp, max_points=150, update_rate=100000)
-        self.data_connector_pv = DataConnector(self.plot_pv, max_points=150, update_rate=100000)
+        self.data_connector_sp = DataConnector(self.plot_sp, max_points=150, update_rate=30)
+        self.data_connector_pv = DataConnector(self.plot_pv, max_points=150, update_rate=30)
 
         self.ui.gridLayout.addWidget(self.live_plot_widget, 2, 0, 1, 4)
 
+        # The position received from the pico gets its own graph, its x axis counts
+        # received samples rather than PID ticks so it can't share the range above
+        self.rx_plot_widget = LivePlotWidget(
+            title="Received position",
+            axisItems={
+                "bottom": LiveAxis("bottom", axisPen="red", textPen="red"),
+                "left": LiveAxis("left", axisPen="red", textPen="red"),
+            },
+            x_range_controller=LiveAxisRange(roll_on_tick=150, offset_left=1.5),
+            **kwargs,
+        )
+        self.rx_plot_widget.x_range_controller.crop_left_offset_to_data = True
+        self.plot_rx = LiveLinePlot(pen="green")
+        self.rx_plot_widget.addItem(self.plot_rx)
+        self.data_connector_rx = DataConnector(self.plot_rx, max_points=150, update_rate=30)
+
+        self.ui.gridLayout.addWidget(self.rx_plot_widget, 3, 0, 1, 4)
+
 
 
 
     def send_start(self):
-        self.serial.send("start")
+        self.serial.send_raw(Serial.START)
 
     def send_pause(self):
-        self.serial.send("pause")
+        self.serial.send_raw(Serial.PAUSE)
 
     def send_stop(self):
-        self.serial.send("stop")
+        self.serial.send_raw(Serial.STOP)
+
+    def _append_samples(self, samples):
+        xs = np.arange(self._rx_sample, self._rx_sample + len(samples))
+        self._rx_sample += len(samples)
+        self.data_connector_rx.cb_append_data_array(samples.tolist(), xs.tolist())
+
+    def _drop_batch(self):
+        # The controller only holds the committed steps, the rest of the batch can simply be thrown away
+        self._batch = np.empty((0, 3))
+        self._batch_pos = 0
 
     def clear_graph(self):
         self.data_connector_pv.clear()
         self.data_connector_sp.clear()
+        self.data_connector_rx.clear()
+        self._rx_sample = 0
 
     def send_values(self):
-        global setpoint
         # This is for sending data to the pico
         # self.message.update({'Kp': float(self.ui.P_value_txt.text())})
         # self.message.update({'Ki': float(self.ui.I_value_txt.text())})
         # self.message.update({'Kd': float(self.ui.D_value_txt.text())})
         # self.message.update({'setpoint': float(self.ui.SetPoint_value_txt.text())})
         # self.serial.send(self.message)
-        params = (float(self.ui.P_value_txt.text()), float(self.ui.I_value_txt.text()), float(self.ui.D_value_txt.text()))
-        self.serial.pid_controller.set_new_params(params)
-        setpoint = float(self.ui.SetPoint_value_txt.text())
+        ui = self.ui
+        new = (float(ui.P_value_txt.text()), float(ui.I_value_txt.text()), float(ui.D_value_txt.text()),
+               float(ui.SetPoint_value_txt.text()))
+        # Nothing to do if the values have not changed since the last send
+        if new == self._last_params:
+            return
+        self._drop_batch()
+        self.serial.pid_controller.set_new_params(new[:3])
+        self.serial.setpoint = new[3]
+        self._last_params = new
 
 
 if __name__ == "__main__":